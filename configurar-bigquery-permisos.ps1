@@ -41,7 +41,9 @@ Write-Host ""
 $roles = @(
     @{Name="BigQuery Data Viewer"; Role="roles/bigquery.dataViewer"},
     @{Name="BigQuery Job User"; Role="roles/bigquery.jobUser"},
-    @{Name="BigQuery Data Editor (opcional)"; Role="roles/bigquery.dataEditor"}
+    # Requerido: escribir resultados y registrar las table functions del despliegue
+    # (bigquery.routines.create/update/get sobre el dataset amn_op_automatic_invoicing)
+    @{Name="BigQuery Data Editor"; Role="roles/bigquery.dataEditor"}
 )
 
 foreach ($roleInfo in $roles) {
@@ -85,6 +87,12 @@ if ($LASTEXITCODE -eq 0) {
     Write-Host "   gcloud projects add-iam-policy-binding $SOURCE_PROJECT \" -ForegroundColor Gray
     Write-Host "     --member=`"serviceAccount:$SERVICE_ACCOUNT`" \" -ForegroundColor Gray
     Write-Host "     --role=`"roles/bigquery.jobUser`"" -ForegroundColor Gray
+    Write-Host ""
+    Write-Host "   gcloud projects add-iam-policy-binding $SOURCE_PROJECT \" -ForegroundColor Gray
+    Write-Host "     --member=`"serviceAccount:$SERVICE_ACCOUNT`" \" -ForegroundColor Gray
+    Write-Host "     --role=`"roles/bigquery.dataEditor`"" -ForegroundColor Gray
+    Write-Host ""
+    Write-Host "   (dataEditor es necesario para registrar las table functions en el despliegue)" -ForegroundColor Gray
 }
 
 Write-Host ""
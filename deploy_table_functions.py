@@ -0,0 +1,60 @@
+"""
+Registra los resúmenes (invoice, partner y settlement) como table functions
+versionadas y parametrizadas en BigQuery, para que el servicio solo tenga que
+ejecutar SELECT * FROM tvf(@p_partner, @p_contract, @p_from, @p_to)
+
+El sufijo de versión es un hash del SQL generado (ver table_function_version):
+una versión ya registrada nunca se reemplaza, y cambiar el SQL registra una
+función nueva sin afectar a las revisiones del servicio que usan la anterior.
+
+Uso:
+    python deploy_table_functions.py            # crea las funciones que falten
+    python deploy_table_functions.py --dry-run  # solo muestra el DDL
+"""
+
+import argparse
+import logging
+import sys
+
+from main import (
+    TABLE_FUNCTION_ARGS,
+    TABLE_FUNCTIONS,
+    get_bigquery_client,
+    scheduler,
+    table_function_name,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def create_statement(query_type: str) -> str:
+    """DDL CREATE TABLE FUNCTION IF NOT EXISTS de un resumen"""
+    build_sql, _ = TABLE_FUNCTIONS[query_type]
+    return (
+        f"CREATE TABLE FUNCTION IF NOT EXISTS `{table_function_name(query_type)}`({TABLE_FUNCTION_ARGS})\n"
+        f"AS {build_sql(param_prefix='')}"
+    )
+
+
+def deploy_table_functions(dry_run: bool = False):
+    """Crea las table functions de resúmenes que aún no estén registradas"""
+    client = None if dry_run else get_bigquery_client()
+    for query_type in TABLE_FUNCTIONS:
+        statement = create_statement(query_type)
+        if dry_run:
+            print(f"{statement};\n")
+            continue
+        scheduler.call('bigquery', lambda: client.query(statement).result())
+        logger.info(f"Table function registrada: {table_function_name(query_type)}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Registra las table functions de resúmenes en BigQuery')
+    parser.add_argument('--dry-run', action='store_true', help='Muestra el DDL sin ejecutarlo')
+    args = parser.parse_args(argv)
+    deploy_table_functions(dry_run=args.dry_run)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
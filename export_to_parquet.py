@@ -0,0 +1,122 @@
+"""
+Módulo para exportar resultados de BigQuery a ficheros Parquet
+(disco local u object storage compatible: gs://, s3://)
+"""
+
+import logging
+import os
+import uuid
+from datetime import date
+from typing import List, Dict, Any, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import fs
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION = 'zstd'
+
+# Tipos de BigQuery -> tipos de Arrow
+ARROW_TYPES = {
+    'STRING': pa.string(),
+    'BYTES': pa.binary(),
+    'INTEGER': pa.int64(),
+    'INT64': pa.int64(),
+    'FLOAT': pa.float64(),
+    'FLOAT64': pa.float64(),
+    'NUMERIC': pa.decimal128(38, 9),
+    'BIGNUMERIC': pa.decimal256(76, 38),
+    'BOOLEAN': pa.bool_(),
+    'BOOL': pa.bool_(),
+    'DATE': pa.date32(),
+    'DATETIME': pa.timestamp('us'),
+    'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+    'TIME': pa.time64('us'),
+}
+
+
+def arrow_schema(schema: List[Tuple[str, str]]) -> pa.Schema:
+    """Convierte un schema [(nombre, tipo BigQuery)] a schema de Arrow"""
+    return pa.schema([(name, ARROW_TYPES.get(field_type, pa.string())) for name, field_type in schema])
+
+
+class ParquetWriter:
+    """
+    Escribe datos página a página en un fichero Parquet comprimido,
+    particionado estilo Hive por tipo de resumen y fecha de ejecución:
+    {root_uri}/summary_type={summary_type}/run_date={YYYY-MM-DD}/part-0.parquet
+
+    Las páginas se escriben en un fichero temporal oculto (los lectores de
+    datasets ignoran los nombres que empiezan por '.') y close() lo mueve a
+    su ruta final, de modo que un fallo a mitad no deja un snapshot truncado
+    """
+
+    def __init__(
+        self,
+        root_uri: str,
+        summary_type: str,
+        run_date: date,
+        schema: List[Tuple[str, str]] = None,
+        compression: str = COMPRESSION
+    ):
+        """
+        Args:
+            root_uri: Directorio raíz (ruta local o URI gs://, s3://)
+            summary_type: Tipo de resumen (query_type)
+            run_date: Fecha de ejecución
+            schema: Columnas [(nombre, tipo BigQuery)]; si no se indica se infiere de la primera página
+            compression: Códec de compresión de Parquet
+        """
+        # Rutas locales sin esquema: FileSystem.from_uri requiere ruta absoluta
+        if '://' not in root_uri:
+            root_uri = os.path.abspath(root_uri)
+        self.filesystem, root = fs.FileSystem.from_uri(root_uri)
+        self.partition_dir = f"{root.rstrip('/')}/summary_type={summary_type}/run_date={run_date.isoformat()}"
+        # Un fichero por partición: cada ejecución del día sobrescribe el snapshot,
+        # igual que la tabla fechada de BigQuery (WRITE_TRUNCATE)
+        self.path = f"{self.partition_dir}/part-0.parquet"
+        self.tmp_path = f"{self.partition_dir}/.part-0.parquet.{uuid.uuid4().hex[:8]}.tmp"
+        self.schema = arrow_schema(schema) if schema else None
+        self.compression = compression
+        self.writer = None
+        self.rows = 0
+
+    def write_page(self, rows: List[Dict[str, Any]]):
+        """Escribe una página de filas como un row group"""
+        if not rows:
+            return
+
+        table = pa.Table.from_pylist(rows, schema=self.schema)
+        if self.writer is None:
+            self.schema = table.schema
+            self.filesystem.create_dir(self.partition_dir, recursive=True)
+            self.writer = pq.ParquetWriter(
+                self.tmp_path, self.schema, filesystem=self.filesystem, compression=self.compression
+            )
+        self.writer.write_table(table)
+        self.rows += table.num_rows
+
+    def close(self) -> str:
+        """Cierra el fichero y retorna su ruta"""
+        if self.writer is None:
+            logger.warning("No hay datos para exportar")
+            return None
+        self.writer.close()
+        self.filesystem.move(self.tmp_path, self.path)
+        logger.info(f"Datos exportados a Parquet: {self.path} ({self.rows} filas)")
+        return self.path
+
+    def abort(self):
+        """Descarta la exportación: elimina el fichero temporal sin tocar el snapshot"""
+        if self.writer is None:
+            return
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+        self.writer = None
+        try:
+            self.filesystem.delete_file(self.tmp_path)
+        except (FileNotFoundError, OSError) as e:
+            logger.warning(f"No se pudo eliminar el fichero temporal {self.tmp_path}: {e}")
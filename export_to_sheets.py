@@ -8,122 +8,193 @@ from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from rate_limiter import scheduler
+from tracing import span
+
 logger = logging.getLogger(__name__)
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
 
-def export_to_sheets(
-    spreadsheet_id: str,
-    sheet_name: str,
-    data: List[Dict[str, Any]],
-    credentials_path: str = None
-):
+def format_value(value, header):
+    """Formatea valores numéricos para la hoja"""
+    if value is None or value == '':
+        return ''
+    # Si es id_partner, formatear como entero
+    if header == 'id_partner' or header.lower() == 'id_partner':
+        try:
+            num_value = float(value)
+            return str(int(num_value))
+        except (ValueError, TypeError):
+            return str(value)
+    # Si es un número, formatear con 2 decimales
+    try:
+        num_value = float(value)
+        # Formatear con 2 decimales, sin notación científica
+        return f"{num_value:.2f}"
+    except (ValueError, TypeError):
+        # Si no es número, devolver como string
+        return str(value)
+
+
+class SheetsWriter:
     """
-    Exporta datos a Google Sheets
-    
-    Args:
-        spreadsheet_id: ID de la hoja de cálculo de Google Sheets
-        sheet_name: Nombre de la hoja dentro del spreadsheet
-        data: Lista de diccionarios con los datos a exportar
-        credentials_path: Ruta al archivo de credenciales (opcional)
+    Escribe datos en una hoja de Google Sheets página a página: la primera
+    página limpia la hoja y escribe encabezados, las siguientes se añaden
+    a continuación, de modo que solo hay una página en memoria
+
+    A diferencia de los sinks de BigQuery y Parquet, la escritura no es
+    atómica: la hoja se limpia al recibir la primera página, así que si la
+    petición falla a mitad la hoja queda a medio escribir hasta la siguiente
+    ejecución correcta
     """
-    if not data:
-        logger.warning("No hay datos para exportar")
-        return
-    
-    try:
+
+    def __init__(
+        self,
+        spreadsheet_id: str,
+        sheet_name: str,
+        headers: List[str] = None,
+        credentials_path: str = None
+    ):
+        """
+        Args:
+            spreadsheet_id: ID de la hoja de cálculo de Google Sheets
+            sheet_name: Nombre de la hoja dentro del spreadsheet
+            headers: Columnas a exportar (por defecto, las claves de la primera fila)
+            credentials_path: Ruta al archivo de credenciales (opcional)
+        """
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.headers = headers
+        self.credentials_path = credentials_path
+        self.service = None
+        self.updated_cells = 0
+
+    def _open(self):
         # Obtener credenciales
-        if credentials_path:
-            creds = service_account.Credentials.from_service_account_file(
-                credentials_path, scopes=SCOPES
-            )
-        else:
-            # Usar credenciales por defecto (Application Default Credentials)
-            from google.auth import default
-            creds, _ = default(scopes=SCOPES)
-        
-        service = build('sheets', 'v4', credentials=creds)
-        
-        # Preparar datos: encabezados + filas
-        if not data:
-            return
-        
-        headers = list(data[0].keys())
-        
-        # Función para formatear valores numéricos
-        def format_value(value, header):
-            if value is None or value == '':
-                return ''
-            # Si es id_partner, formatear como entero
-            if header == 'id_partner' or header.lower() == 'id_partner':
-                try:
-                    num_value = float(value)
-                    return str(int(num_value))
-                except (ValueError, TypeError):
-                    return str(value)
-            # Si es un número, formatear con 2 decimales
-            try:
-                num_value = float(value)
-                # Formatear con 2 decimales, sin notación científica
-                return f"{num_value:.2f}"
-            except (ValueError, TypeError):
-                # Si no es número, devolver como string
-                return str(value)
-        
-        # Preparar valores con formato numérico
-        values = [headers] + [[format_value(row.get(h, ''), h) for h in headers] for row in data]
-        
-        # Limpiar hoja existente o crear nueva
+        with span('sheets.credentials'):
+            if self.credentials_path:
+                creds = service_account.Credentials.from_service_account_file(
+                    self.credentials_path, scopes=SCOPES
+                )
+            else:
+                # Usar credenciales por defecto (Application Default Credentials)
+                from google.auth import default
+                creds, _ = default(scopes=SCOPES)
+
+            self.service = build('sheets', 'v4', credentials=creds)
+        spreadsheets = self.service.spreadsheets()
+
+        # Crear la hoja si no existe
         try:
-            # Intentar obtener la hoja
-            spreadsheet = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-            sheet_exists = any(s['properties']['title'] == sheet_name 
-                             for s in spreadsheet.get('sheets', []))
-            
+            with span('sheets.get'):
+                spreadsheet = scheduler.call(
+                    'sheets', spreadsheets.get(spreadsheetId=self.spreadsheet_id).execute
+                )
+            sheet_exists = any(s['properties']['title'] == self.sheet_name
+                               for s in spreadsheet.get('sheets', []))
+
             if not sheet_exists:
-                # Crear nueva hoja
                 request_body = {
                     'requests': [{
                         'addSheet': {
                             'properties': {
-                                'title': sheet_name
+                                'title': self.sheet_name
                             }
                         }
                     }]
                 }
-                service.spreadsheets().batchUpdate(
-                    spreadsheetId=spreadsheet_id,
-                    body=request_body
-                ).execute()
+                with span('sheets.add_sheet'):
+                    scheduler.call('sheets', spreadsheets.batchUpdate(
+                        spreadsheetId=self.spreadsheet_id,
+                        body=request_body
+                    ).execute)
         except HttpError as e:
             logger.error(f"Error al verificar/crear hoja: {e}")
-            return
-        
+            raise
+
         # Limpiar contenido existente (sobrescribir todo)
         # Usar un rango grande para asegurar que se limpie todo
-        range_name = f"{sheet_name}!A1:ZZ10000"
+        range_name = f"{self.sheet_name}!A1:ZZ10000"
         try:
-            service.spreadsheets().values().clear(
-                spreadsheetId=spreadsheet_id,
-                range=range_name
-            ).execute()
-            logger.info(f"Contenido anterior de la hoja '{sheet_name}' limpiado")
+            with span('sheets.clear'):
+                scheduler.call('sheets', spreadsheets.values().clear(
+                    spreadsheetId=self.spreadsheet_id,
+                    range=range_name
+                ).execute)
+            logger.info(f"Contenido anterior de la hoja '{self.sheet_name}' limpiado")
         except HttpError as e:
             logger.warning(f"No se pudo limpiar la hoja (puede que no exista): {e}")
-        
-        # Escribir datos
-        body = {'values': values}
-        result = service.spreadsheets().values().update(
-            spreadsheetId=spreadsheet_id,
-            range=f"{sheet_name}!A1",
-            valueInputOption='RAW',
-            body=body
-        ).execute()
-        
-        logger.info(f"Datos exportados exitosamente: {result.get('updatedCells')} celdas actualizadas")
-        
-    except HttpError as e:
-        logger.error(f"Error exportando a Google Sheets: {e}")
-        raise
 
+    def write_page(self, rows: List[Dict[str, Any]]):
+        """Escribe una página de filas en la hoja"""
+        if not rows:
+            return
+
+        first_page = self.service is None
+        if first_page:
+            self._open()
+            self.headers = self.headers or list(rows[0].keys())
+
+        values = [[format_value(row.get(h, ''), h) for h in self.headers] for row in rows]
+        values_api = self.service.spreadsheets().values()
+
+        try:
+            with span('sheets.update' if first_page else 'sheets.append', rows=len(rows)) as write_span:
+                if first_page:
+                    result = scheduler.call('sheets', values_api.update(
+                        spreadsheetId=self.spreadsheet_id,
+                        range=f"{self.sheet_name}!A1",
+                        valueInputOption='RAW',
+                        body={'values': [self.headers] + values}
+                    ).execute)
+                else:
+                    # append amplía la hoja si hace falta y escribe tras la última fila
+                    result = scheduler.call('sheets', values_api.append(
+                        spreadsheetId=self.spreadsheet_id,
+                        range=f"{self.sheet_name}!A1",
+                        valueInputOption='RAW',
+                        body={'values': values}
+                    ).execute).get('updates', {})
+                write_span.set_attribute('cells', result.get('updatedCells') or 0)
+        except HttpError as e:
+            logger.error(f"Error exportando a Google Sheets: {e}")
+            raise
+
+        self.updated_cells += result.get('updatedCells') or 0
+
+    def close(self):
+        """Finaliza la exportación"""
+        if self.service is None:
+            logger.warning("No hay datos para exportar")
+            return
+        logger.info(f"Datos exportados exitosamente: {self.updated_cells} celdas actualizadas")
+
+    def abort(self):
+        """Registra que la exportación quedó incompleta (la hoja no se restaura)"""
+        if self.service is None:
+            return
+        logger.warning(
+            f"Exportación a la hoja '{self.sheet_name}' interrumpida: "
+            f"la hoja queda a medio escribir ({self.updated_cells} celdas actualizadas)"
+        )
+
+
+def export_to_sheets(
+    spreadsheet_id: str,
+    sheet_name: str,
+    data: List[Dict[str, Any]],
+    credentials_path: str = None
+):
+    """
+    Exporta datos a Google Sheets
+
+    Args:
+        spreadsheet_id: ID de la hoja de cálculo de Google Sheets
+        sheet_name: Nombre de la hoja dentro del spreadsheet
+        data: Lista de diccionarios con los datos a exportar
+        credentials_path: Ruta al archivo de credenciales (opcional)
+    """
+    writer = SheetsWriter(spreadsheet_id, sheet_name, credentials_path=credentials_path)
+    writer.write_page(data)
+    writer.close()
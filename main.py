@@ -6,13 +6,22 @@ Ejecuta queries de BigQuery y exporta resultados a Google Sheets
 import json
 import logging
 import os
-from datetime import datetime
-from typing import Any, Dict, Optional
+import calendar
+import concurrent.futures
+import hashlib
+import io
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 from flask import Request
 from google.cloud import bigquery
+from google.cloud.bigquery.retry import DEFAULT_RETRY
 from google.auth import default
 
+from rate_limiter import DeadlineExceeded, remaining_seconds, request_deadline, scheduler
+from tracing import span
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -24,6 +33,26 @@ DATASET_ID = 'amn_op_automatic_invoicing'
 # Configuración de Google Sheets
 GOOGLE_SHEETS_ID = os.environ.get('GOOGLE_SHEETS_ID', '14zyGkUGjj3HP4klvwmUKHukHc_1eN6FRLAazcwoNQZ8')
 
+# Configuración de sinks de salida
+DEFAULT_SINKS = os.environ.get('DEFAULT_SINKS', 'bigquery,sheets')
+PARQUET_SINK_ROOT = os.environ.get('PARQUET_SINK_ROOT', '')
+
+# Table functions versionadas con los resúmenes (ver deploy_table_functions.py)
+USE_TABLE_FUNCTIONS = os.environ.get('USE_TABLE_FUNCTIONS', 'true').lower() == 'true'
+
+# Máximo de fechas de corte por petición as-of: cada corte repite el escaneo del histórico
+MAX_PERIOD_ENDS = int(os.environ.get('MAX_PERIOD_ENDS', '60'))
+
+# Filas por página al descargar resultados: acota la memoria de todo el pipeline
+QUERY_PAGE_SIZE = int(os.environ.get('QUERY_PAGE_SIZE', '5000'))
+
+# Bytes de NDJSON acumulados antes de lanzar un load job a la tabla de staging
+BIGQUERY_LOAD_BATCH_BYTES = int(os.environ.get('BIGQUERY_LOAD_BATCH_BYTES', str(16 * 1024 * 1024)))
+
+# Schema [(nombre, tipo BigQuery)] y generador de páginas de filas
+Schema = List[Tuple[str, str]]
+QueryPages = Tuple[Schema, Iterator[List[Dict[str, Any]]]]
+
 # Tablas
 HIST = f'{PROJECT_ID}.{DATASET_ID}.historic_order_item_sales'
 T_CC = f'{PROJECT_ID}.{DATASET_ID}.Commercial_Condition__c'
@@ -32,6 +61,13 @@ T_TAXES = f'{PROJECT_ID}.{DATASET_ID}.historic_taxes_applied'
 T_FEES = f'{PROJECT_ID}.{DATASET_ID}.historic_fixed_fees'
 T_ACCOUNT = f'{PROJECT_ID}.{DATASET_ID}.Account'
 
+# Las llamadas a la API (sondeo de jobs, descarga de páginas, tablas) usan el
+# retry por defecto de la librería, porque la descarga de páginas ocurre fuera
+# de QuotaScheduler. El reenvío de jobs fallidos lo hace QuotaScheduler
+# (y lo contabiliza): job_retry=None evita que la librería los reenvíe.
+BIGQUERY_RETRY = DEFAULT_RETRY
+
+
 # Inicializar cliente de BigQuery
 def get_bigquery_client():
     """
@@ -39,31 +75,83 @@ def get_bigquery_client():
     Esto usará la cuenta de servicio del servicio Cloud Run si está configurada,
     o las credenciales del entorno si están disponibles.
     """
+    with span('bigquery.credentials'):
+        try:
+            # Intentar usar Application Default Credentials
+            client = bigquery.Client(project=PROJECT_ID)
+            return client
+        except Exception as e:
+            logger.error(f"Error inicializando cliente BigQuery: {e}")
+            # Fallback: crear cliente sin especificar proyecto
+            return bigquery.Client()
+
+
+def wait_for_job(job, **kwargs):
+    """
+    Espera el resultado de un job de BigQuery dentro del deadline de la
+    petición. Si se agota, cancela el job y lanza DeadlineExceeded.
+    """
     try:
-        # Intentar usar Application Default Credentials
-        client = bigquery.Client(project=PROJECT_ID)
-        return client
-    except Exception as e:
-        logger.error(f"Error inicializando cliente BigQuery: {e}")
-        # Fallback: crear cliente sin especificar proyecto
-        return bigquery.Client()
+        return job.result(timeout=remaining_seconds(), retry=BIGQUERY_RETRY, **kwargs)
+    except concurrent.futures.TimeoutError:
+        try:
+            job.cancel()
+        except Exception as e:
+            logger.warning(f"No se pudo cancelar el job {job.job_id}: {e}")
+        raise DeadlineExceeded(f"Deadline de la petición agotado esperando el job {job.job_id}")
 
 
-def execute_query(query: str, params: Optional[Dict] = None) -> list:
-    """Ejecuta una query en BigQuery y retorna los resultados"""
+def execute_query_pages(query: str, params: Optional[Dict] = None, page_size: int = QUERY_PAGE_SIZE) -> QueryPages:
+    """
+    Ejecuta una query en BigQuery y retorna (schema, páginas): el schema como
+    [(nombre, tipo)] y un generador que descarga una página de filas cada vez
+    """
     client = get_bigquery_client()
     
     job_config = bigquery.QueryJobConfig()
     if params:
         job_config.query_parameters = [
-            bigquery.ScalarQueryParameter(key, value_type, value)
+            bigquery.ArrayQueryParameter(key, value_type, list(value))
+            if isinstance(value, (list, tuple))
+            else bigquery.ScalarQueryParameter(key, value_type, value)
             for key, (value, value_type) in params.items()
         ]
     
-    query_job = client.query(query, job_config=job_config)
-    results = query_job.result()
+    def run_query():
+        # Si el job falla por cuota hay que volver a enviarlo, por eso
+        # el envío y la espera del resultado se reintentan juntos
+        query_job = client.query(query, job_config=job_config, retry=BIGQUERY_RETRY, job_retry=None)
+        results = wait_for_job(query_job, page_size=page_size, job_retry=None)
+        query_span.set_attribute('job_id', query_job.job_id)
+        query_span.set_attribute('bytes', query_job.total_bytes_processed or 0)
+        query_span.set_attribute('cache_hit', bool(query_job.cache_hit))
+        query_span.set_attribute('rows', results.total_rows or 0)
+        return results
+    
+    # Cola del job y ejecución en BigQuery
+    with span('bigquery.query') as query_span:
+        results = scheduler.call('bigquery', run_query)
+    schema = [(field.name, field.field_type) for field in results.schema]
+    
+    def pages():
+        page_iter = iter(results.pages)
+        while True:
+            # Descarga y conversión de cada página
+            with span('bigquery.download_page') as page_span:
+                page = next(page_iter, None)
+                rows = [dict(row) for row in page] if page is not None else []
+                page_span.set_attribute('rows', len(rows))
+            if page is None:
+                return
+            yield rows
     
-    return [dict(row) for row in results]
+    return schema, pages()
+
+
+def execute_query(query: str, params: Optional[Dict] = None) -> list:
+    """Ejecuta una query en BigQuery y retorna los resultados"""
+    _, pages = execute_query_pages(query, params)
+    return [row for page in pages for row in page]
 
 
 def get_partner_id_by_contract(cd_contract: str) -> Optional[str]:
@@ -122,11 +210,43 @@ def get_account_name(id_partner: int) -> Optional[str]:
     return results[0]['Name'] if results else None
 
 
-def get_invoice_summary(where_clause: str = '') -> list:
+# Argumentos de las table functions de resúmenes (NULL = sin filtro)
+TABLE_FUNCTION_ARGS = 'p_partner INT64, p_contract STRING, p_from DATE, p_to DATE'
+
+
+def history_filter(param_prefix: str = '@') -> str:
+    """
+    WHERE sobre el histórico con los filtros de la petición. Con '@' referencia
+    parámetros de query; con '' los argumentos de la table function. El texto
+    no depende de los valores, así las peticiones repetidas aprovechan la caché.
+    SAFE_CAST porque BigQuery no garantiza el cortocircuito del OR: un
+    id_partner o dt_input que no convierte limpio no debe hacer fallar la
+    query aunque no se filtre por él.
+    """
+    p = param_prefix
+    return f"""
+      WHERE ({p}p_partner IS NULL OR SAFE_CAST(REPLACE(id_partner, ',', '') AS INT64) = {p}p_partner)
+        AND ({p}p_contract IS NULL OR cd_contract = {p}p_contract)
+        AND ({p}p_from IS NULL OR SAFE_CAST(dt_input AS DATE) >= {p}p_from)
+        AND ({p}p_to IS NULL OR SAFE_CAST(dt_input AS DATE) <= {p}p_to)"""
+
+
+def summary_params(filters: Optional[Dict[str, Any]] = None) -> Dict[str, tuple]:
+    """Parámetros de query para history_filter a partir de los filtros de la petición"""
+    filters = filters or {}
+    return {
+        'p_partner': (filters.get('id_partner'), 'INT64'),
+        'p_contract': (filters.get('cd_contract'), 'STRING'),
+        'p_from': (filters.get('date_from'), 'DATE'),
+        'p_to': (filters.get('date_to'), 'DATE'),
+    }
+
+
+def invoice_summary_sql(param_prefix: str = '@') -> str:
     """Query RESUMEN INVOICES - Completa con CTEs"""
-    query = f"""
+    return f"""
     WITH base AS (
-      SELECT * FROM `{HIST}`{where_clause}
+      SELECT * FROM `{HIST}`{history_filter(param_prefix)}
     ),
     sessions AS (SELECT DISTINCT session_id FROM base),
     taxes_tab AS (
@@ -202,18 +322,16 @@ def get_invoice_summary(where_clause: str = '') -> list:
     SELECT invoice_id, dt_input, dt_invoice_from, dt_invoice_to, invoice_link,
            commission, fixed_fees, total_fever_share, taxes
     FROM fin
-    ORDER BY dt_input DESC NULLS FIRST
     """
-    return execute_query(query)
 
 
-def get_partner_summary(where_clause: str = '') -> list:
+def partner_summary_sql(param_prefix: str = '@') -> str:
     """
     Query RESUMEN POR PARTNER - Una línea por partner_id con métricas acumuladas
     """
-    query = f"""
+    return f"""
     WITH base AS (
-      SELECT * FROM `{HIST}`{where_clause}
+      SELECT * FROM `{HIST}`{history_filter(param_prefix)}
     ),
     sessions AS (
       SELECT DISTINCT session_id, id_partner
@@ -445,15 +563,234 @@ def get_partner_summary(where_clause: str = '') -> list:
     LEFT JOIN commission_invoice_partner  ci ON p.id_partner = ci.id_partner
     LEFT JOIN fixed_fees_invoice_partner  fi ON p.id_partner = fi.id_partner
     LEFT JOIN fixed_fees_settlement_partner fs ON p.id_partner = fs.id_partner
-    ORDER BY p.id_partner
     """
-    return execute_query(query)
 
 
-def get_settlement_summary(where_clause: str = '') -> list:
-    """Query RESUMEN SETTLEMENT - Completa con CTEs"""
+def get_partner_summary_as_of(period_ends: List[date], filters: Dict[str, Any] = None) -> QueryPages:
+    """
+    Query RESUMEN POR PARTNER "as-of" - Una línea por partner_id y periodo con
+    las métricas acumuladas hasta cada fecha de corte (dt_input <= period_end).
+    Se calcula con un único escaneo: cada fila se asigna a su periodo y los
+    acumulados se obtienen con funciones de ventana.
+    """
     query = f"""
-    WITH base AS (SELECT * FROM `{HIST}`{where_clause}),
+    WITH periods AS (
+      SELECT
+        period_end,
+        LAG(period_end) OVER (ORDER BY period_end) AS period_start,
+        ROW_NUMBER() OVER (ORDER BY period_end) AS period_idx
+      FROM UNNEST(@period_ends) AS period_end
+    ),
+    -- Cada fila del histórico cae en el primer corte >= dt_input
+    base AS (
+      SELECT
+        h.* REPLACE (CAST(REPLACE(CAST(h.id_partner AS STRING), ',', '') AS INT64) AS id_partner),
+        p.period_idx
+      FROM (SELECT * FROM `{HIST}`{history_filter()}) h
+      JOIN periods p
+        ON CAST(h.dt_input AS DATE) <= p.period_end
+       AND (p.period_start IS NULL OR CAST(h.dt_input AS DATE) > p.period_start)
+    ),
+    sessions AS (
+      SELECT session_id, id_partner, MIN(period_idx) AS period_idx
+      FROM base
+      GROUP BY session_id, id_partner
+    ),
+    taxes_tab AS (
+      SELECT
+        session_id,
+        ds_tax_apply_to,
+        SUM(nm_tax_rate) / 100 AS tax
+      FROM `{T_TAXES}`
+      WHERE session_id IN (SELECT session_id FROM sessions)
+      GROUP BY session_id, ds_tax_apply_to
+    ),
+    -- [2] Commission tab de invoice por periodo
+    commission_invoice_period AS (
+      SELECT
+        h.id_partner,
+        h.period_idx,
+        SUM(
+          CASE
+            WHEN h.item_status = 'validated/expired' THEN h.variable_cc_for_fever
+            WHEN h.item_status = 'canceled'           THEN h.AMOUNT_TO_COLLECT_FEVER
+            ELSE 0
+          END
+        ) AS ticketing_commission,
+        SUM(
+          CASE
+            WHEN h.item_status = 'validated/expired' THEN h.variable_cc_for_fever * COALESCE(ts.tax, td.tax, 0)
+            WHEN h.item_status = 'canceled'           THEN h.AMOUNT_TO_COLLECT_FEVER * COALESCE(ts.tax, td.tax, 0)
+            ELSE 0
+          END
+        ) AS tax_commission
+      FROM base h
+      LEFT JOIN taxes_tab AS ts
+        ON ts.session_id = h.session_id
+       AND ts.ds_tax_apply_to = CAST(h.id_plan AS STRING)
+      LEFT JOIN taxes_tab AS td
+        ON td.session_id = h.session_id
+       AND td.ds_tax_apply_to = 'default'
+      WHERE h.item_status IN ('validated/expired','canceled')
+      GROUP BY h.id_partner, h.period_idx
+    ),
+    -- [3] Marketing fee de invoice (la sesión cuenta desde su primer periodo)
+    fixed_fees_invoice_period AS (
+      SELECT
+        s.id_partner,
+        s.period_idx,
+        COALESCE(
+          SUM(CASE WHEN f.ds_fixed_type = 'Marketing'
+                   THEN f.fixed_fee_invoice END), 0
+        ) AS invoice_mkt_fixed_fee
+      FROM `{T_FEES}` AS f
+      JOIN sessions s USING (session_id)
+      GROUP BY s.id_partner, s.period_idx
+    ),
+    -- Fixed fees settlement: total y taxes (Cash advance nunca lleva tax)
+    fixed_fees_settlement_period AS (
+      SELECT
+        s.id_partner,
+        s.period_idx,
+        SUM(
+          CASE WHEN f.ds_fixed_type IN ('Marketing', 'Cash advance', 'Sponsorship', 'Reconciliation', 'Other')
+               THEN f.fixed_fee_settlement ELSE 0 END
+        ) AS fixed_fees_total,
+        SUM(
+          CASE
+            WHEN f.ds_fixed_type IN ('Marketing', 'Sponsorship', 'Reconciliation', 'Other') AND f.apply_tax = TRUE
+              THEN f.fixed_fee_settlement * COALESCE(ts.tax, td.tax, 0)
+            ELSE 0
+          END
+        ) AS fixed_fees_tax_total
+      FROM `{T_FEES}` AS f
+      JOIN sessions s USING (session_id)
+      LEFT JOIN taxes_tab AS ts
+        ON ts.session_id = f.session_id
+       AND ts.ds_tax_apply_to = f.ds_fixed_description
+      LEFT JOIN taxes_tab AS td
+        ON td.session_id = f.session_id
+       AND td.ds_tax_apply_to = 'default'
+      GROUP BY s.id_partner, s.period_idx
+    ),
+    -- Para cancelados se usa el máximo histórico del item conocido hasta cada corte
+    consolidated_info_tab AS (
+      SELECT
+        id_partner,
+        period_idx,
+        item_status,
+        CASE
+          WHEN item_status = 'canceled'
+            THEN IFNULL(-MAX(FT_COLLECTED_BY_FEVER) OVER item_history, 0)
+          ELSE ft_collected_by_fever
+        END AS collected_by_fever
+      FROM base
+      WINDOW item_history AS (
+        PARTITION BY id_order_item
+        ORDER BY period_idx
+        RANGE BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+      )
+    ),
+    revenue_period AS (
+      SELECT
+        id_partner,
+        period_idx,
+        SUM(
+          CASE
+            WHEN item_status <> 'purchased'
+              THEN collected_by_fever
+            ELSE 0
+          END
+        ) AS revenue_collected_by_fever_no_purchased
+      FROM consolidated_info_tab
+      GROUP BY id_partner, period_idx
+    ),
+    -- Rejilla partner x periodo desde el primer periodo con actividad
+    partner_periods AS (
+      SELECT fp.id_partner, p.period_idx, p.period_end
+      FROM (
+        SELECT id_partner, MIN(period_idx) AS first_period_idx
+        FROM base
+        GROUP BY id_partner
+      ) fp
+      JOIN periods p
+        ON p.period_idx >= fp.first_period_idx
+    ),
+    period_totals AS (
+      SELECT
+        pp.id_partner,
+        pp.period_idx,
+        pp.period_end,
+        COALESCE(r.revenue_collected_by_fever_no_purchased, 0) AS gross_collected,
+        COALESCE(ci.ticketing_commission, 0) AS commission,
+        COALESCE(fi.invoice_mkt_fixed_fee, 0) AS marketing_fees,
+        COALESCE(fs.fixed_fees_total, 0) AS fixed_fees_total,
+        COALESCE(ci.tax_commission, 0) + COALESCE(fs.fixed_fees_tax_total, 0) AS total_taxes
+      FROM partner_periods pp
+      LEFT JOIN revenue_period               r  USING (id_partner, period_idx)
+      LEFT JOIN commission_invoice_period    ci USING (id_partner, period_idx)
+      LEFT JOIN fixed_fees_invoice_period    fi USING (id_partner, period_idx)
+      LEFT JOIN fixed_fees_settlement_period fs USING (id_partner, period_idx)
+    )
+    SELECT
+      period_end,
+      id_partner,
+      SUM(gross_collected) OVER cumulative AS gross_collected,
+      SUM(commission) OVER cumulative AS commission,
+      SUM(marketing_fees) OVER cumulative AS marketing_fees,
+      SUM(total_taxes) OVER cumulative AS total_taxes,
+      -- partner payment = [1] - [2] - fixed_fees_total (sin taxes) - [4]
+      SUM(gross_collected - commission - fixed_fees_total - total_taxes) OVER cumulative AS pago_al_partner
+    FROM period_totals
+    WINDOW cumulative AS (
+      PARTITION BY id_partner
+      ORDER BY period_idx
+      ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+    )
+    ORDER BY id_partner, period_end
+    """
+    params = summary_params(filters)
+    params['period_ends'] = (period_ends, 'DATE')
+    return execute_query_pages(query, params)
+
+
+def parse_period_ends(data: Dict[str, Any]) -> List[date]:
+    """
+    Obtiene las fechas de corte de la petición: `period_ends` (lista o separadas
+    por comas) o cortes mensuales (fin de mes) entre `period_from` y `period_to`.
+    El último corte mensual se recorta a `period_to` para no incluir datos
+    posteriores al fin pedido. Admite como máximo MAX_PERIOD_ENDS cortes.
+    """
+    period_ends = data.get('period_ends')
+    if period_ends:
+        if isinstance(period_ends, str):
+            period_ends = period_ends.split(',')
+        dates = [date.fromisoformat(str(value).strip()) for value in period_ends]
+    elif data.get('period_from') and data.get('period_to'):
+        start = date.fromisoformat(data['period_from'])
+        end = date.fromisoformat(data['period_to'])
+        dates = []
+        year, month = start.year, start.month
+        while (year, month) <= (end.year, end.month):
+            if len(dates) >= MAX_PERIOD_ENDS:
+                raise ValueError(f"Demasiadas fechas de corte (máximo {MAX_PERIOD_ENDS})")
+            dates.append(min(end, date(year, month, calendar.monthrange(year, month)[1])))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    else:
+        raise ValueError("Se requiere 'period_ends' o 'period_from' y 'period_to'")
+    
+    if not dates:
+        raise ValueError("No hay fechas de corte")
+    dates = sorted(set(dates))
+    if len(dates) > MAX_PERIOD_ENDS:
+        raise ValueError(f"Demasiadas fechas de corte: {len(dates)} (máximo {MAX_PERIOD_ENDS})")
+    return dates
+
+
+def settlement_summary_sql(param_prefix: str = '@') -> str:
+    """Query RESUMEN SETTLEMENT - Completa con CTEs"""
+    return f"""
+    WITH base AS (SELECT * FROM `{HIST}`{history_filter(param_prefix)}),
     sessions AS (SELECT DISTINCT session_id FROM base),
     taxes_tab AS (
       SELECT session_id, ds_tax_apply_to, SUM(nm_tax_rate)/100 AS tax
@@ -551,57 +888,503 @@ def get_settlement_summary(where_clause: str = '') -> list:
       executed_commission_w_tax, cancelled_commission_w_tax, ticketing_advance_commission_w_tax,
       mkt_fixed_fee_w_tax, cash_advance_w_tax, other_fixed_fee_w_tax, partner_settlement
     FROM fin
-    ORDER BY dt_input DESC NULLS FIRST
     """
-    return execute_query(query)
 
 
-def save_results_to_bigquery(results: list, table_name: str, dataset_id: str = DATASET_ID):
-    """Guarda resultados en una tabla de BigQuery"""
-    if not results:
-        logger.warning(f"No hay resultados para guardar en {table_name}")
-        return
-    
-    client = get_bigquery_client()
-    table_ref = client.dataset(dataset_id).table(table_name)
-    
-    # Crear tabla si no existe
-    job_config = bigquery.LoadJobConfig(
-        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
-        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
-        autodetect=True
+# Resúmenes registrados como table functions: query_type -> (SQL, ORDER BY del resultado)
+TABLE_FUNCTIONS = {
+    'invoice_summary': (invoice_summary_sql, 'dt_input DESC NULLS FIRST'),
+    'partner_summary': (partner_summary_sql, 'id_partner'),
+    'settlement_summary': (settlement_summary_sql, 'dt_input DESC NULLS FIRST'),
+}
+
+
+def table_function_version(query_type: str) -> str:
+    """
+    Versión de la table function de un resumen: hash del SQL generado. Cambiar
+    el SQL crea una función nueva en vez de reemplazar la que usan las
+    revisiones del servicio que siguen en ejecución.
+    """
+    build_sql, _ = TABLE_FUNCTIONS[query_type]
+    body = f"{TABLE_FUNCTION_ARGS}\n{build_sql(param_prefix='')}"
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()[:12]
+
+
+def table_function_name(query_type: str) -> str:
+    """Nombre completo de la table function versionada de un resumen"""
+    return f'{PROJECT_ID}.{DATASET_ID}.{query_type}_{table_function_version(query_type)}'
+
+
+# Table functions que no están desplegadas en este proyecto (se comprueba una vez por proceso)
+_missing_table_functions = set()
+
+
+def is_missing_table_function(error: Exception) -> bool:
+    """
+    Indica si el error de la query se debe a que la table function no existe.
+    BigQuery lo suele reportar como 400 invalidQuery ("Table-valued function
+    not found: ..." / "Function not found: ...") y no como 404, así que
+    además del código se revisa el mensaje.
+    """
+    status = getattr(error, 'code', None)
+    reasons = {d.get('reason') for d in getattr(error, 'errors', None) or [] if isinstance(d, dict)}
+    if status == 404:
+        return True
+    message = str(getattr(error, 'message', None) or error).lower()
+    return (
+        status == 400
+        and (not reasons or 'invalidQuery' in reasons or 'notFound' in reasons)
+        and 'function' in message
+        and 'not found' in message
     )
+
+
+def run_summary(query_type: str, filters: Dict[str, Any] = None) -> QueryPages:
+    """
+    Ejecuta un resumen con los filtros como parámetros. Por defecto llama a la
+    table function registrada; si no está desplegada (o USE_TABLE_FUNCTIONS
+    es false) ejecuta el mismo SQL en línea, también parametrizado.
+    """
+    build_sql, order_by = TABLE_FUNCTIONS[query_type]
+    params = summary_params(filters)
     
-    # Convertir resultados a JSON
-    json_rows = [json.dumps(row, default=str) for row in results]
+    name = table_function_name(query_type)
+    if USE_TABLE_FUNCTIONS and name not in _missing_table_functions:
+        query = f"""
+        SELECT * FROM `{name}`(@p_partner, @p_contract, @p_from, @p_to)
+        ORDER BY {order_by}
+        """
+        try:
+            return execute_query_pages(query, params)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            if not is_missing_table_function(e):
+                raise
+            _missing_table_functions.add(name)
+            logger.warning(f"Table function {name} no encontrada, usando SQL en línea")
     
-    job = client.load_table_from_json(
-        [json.loads(row) for row in json_rows],
-        table_ref,
-        job_config=job_config
+    return execute_query_pages(f"{build_sql()}\n    ORDER BY {order_by}\n", params)
+
+
+def get_invoice_summary(filters: Dict[str, Any] = None) -> QueryPages:
+    """Query RESUMEN INVOICES"""
+    return run_summary('invoice_summary', filters)
+
+
+def get_partner_summary(filters: Dict[str, Any] = None) -> QueryPages:
+    """Query RESUMEN POR PARTNER"""
+    return run_summary('partner_summary', filters)
+
+
+def get_settlement_summary(filters: Dict[str, Any] = None) -> QueryPages:
+    """Query RESUMEN SETTLEMENT"""
+    return run_summary('settlement_summary', filters)
+
+
+def get_reconciliation_data(filters: Dict[str, Any] = None) -> QueryPages:
+    """
+    Query CONCILIACIÓN - Una línea por partner_id y session_id con los importes
+    de RESUMEN POR PARTNER (pago_al_partner), RESUMEN SETTLEMENT
+    (partner_settlement, con las reglas y el grano de esa query) y RESUMEN
+    INVOICES (comisión), calculados en una sola pasada sobre los mismos
+    intermedios (base, taxes y fixed fees)
+    """
+    query = f"""
+    WITH base AS (
+      SELECT
+        h.*,
+        CASE
+          WHEN h.item_status = 'canceled'
+            THEN IFNULL(-MAX(h.FT_COLLECTED_BY_FEVER) OVER (PARTITION BY h.id_order_item), 0)
+          ELSE h.ft_collected_by_fever
+        END AS collected_by_fever
+      FROM `{HIST}` h{history_filter()}
+    ),
+    sessions AS (SELECT DISTINCT session_id FROM base),
+    taxes_tab AS (
+      SELECT session_id, ds_tax_apply_to, SUM(nm_tax_rate)/100 AS tax
+      FROM `{T_TAXES}`
+      WHERE session_id IN (SELECT session_id FROM sessions)
+      GROUP BY session_id, ds_tax_apply_to
+    ),
+    fees_tab AS (
+      SELECT
+        f.session_id, f.ds_fixed_type, f.ds_fixed_description, f.apply_tax,
+        f.fixed_fee_invoice, f.fixed_fee_settlement,
+        COALESCE(ts.tax, td.tax, 0) AS tax_rate
+      FROM `{T_FEES}` AS f
+      JOIN sessions s USING (session_id)
+      LEFT JOIN taxes_tab AS ts ON ts.session_id = f.session_id AND ts.ds_tax_apply_to = f.ds_fixed_description
+      LEFT JOIN taxes_tab AS td ON td.session_id = f.session_id AND td.ds_tax_apply_to = 'default'
+    ),
+    fees_session AS (
+      SELECT
+        session_id,
+        -- Reglas de RESUMEN POR PARTNER (por ds_fixed_type, Cash advance sin tax)
+        SUM(CASE WHEN ds_fixed_type IN ('Marketing', 'Cash advance', 'Sponsorship', 'Reconciliation', 'Other')
+                 THEN fixed_fee_settlement ELSE 0 END) AS partner_fixed_fees,
+        SUM(CASE WHEN ds_fixed_type IN ('Marketing', 'Sponsorship', 'Reconciliation', 'Other') AND apply_tax = TRUE
+                 THEN fixed_fee_settlement * tax_rate ELSE 0 END) AS partner_fixed_fees_tax,
+        -- Reglas de RESUMEN SETTLEMENT (por ds_fixed_description)
+        COALESCE(SUM(CASE WHEN ds_fixed_description = 'Marketing'
+                          THEN fixed_fee_settlement + fixed_fee_settlement * tax_rate END), 0)
+        + COALESCE(SUM(CASE WHEN ds_fixed_description = 'Cash advance'
+                            THEN fixed_fee_settlement END), 0)
+        + COALESCE(SUM(CASE WHEN ds_fixed_description NOT IN ('Marketing','Cash advance')
+                            THEN CASE WHEN CAST(apply_tax AS STRING) = 'No' OR apply_tax = FALSE THEN fixed_fee_settlement
+                                      ELSE fixed_fee_settlement + fixed_fee_settlement * tax_rate END END), 0)
+          AS settlement_fixed_fees_w_tax
+      FROM fees_tab
+      GROUP BY session_id
+    ),
+    items_session AS (
+      SELECT
+        CAST(REPLACE(CAST(h.id_partner AS STRING), ',', '') AS INT64) AS id_partner,
+        h.session_id,
+        -- Comisión de invoice (también es la comisión de RESUMEN POR PARTNER)
+        SUM(CASE WHEN h.item_status = 'validated/expired' THEN h.variable_cc_for_fever
+                 WHEN h.item_status = 'canceled'           THEN h.AMOUNT_TO_COLLECT_FEVER ELSE 0 END) AS invoice_commission,
+        SUM(CASE WHEN h.item_status = 'validated/expired' THEN h.variable_cc_for_fever * COALESCE(ts.tax, td.tax, 0)
+                 WHEN h.item_status = 'canceled'           THEN h.AMOUNT_TO_COLLECT_FEVER * COALESCE(ts.tax, td.tax, 0)
+                 ELSE 0 END) AS invoice_commission_tax,
+        SUM(CASE WHEN h.item_status <> 'purchased' THEN h.collected_by_fever ELSE 0 END) AS revenue_collected_by_fever_no_purchased
+      FROM base h
+      LEFT JOIN taxes_tab AS ts ON ts.session_id = h.session_id AND ts.ds_tax_apply_to = CAST(h.id_plan AS STRING)
+      LEFT JOIN taxes_tab AS td ON td.session_id = h.session_id AND td.ds_tax_apply_to = 'default'
+      GROUP BY 1, 2
+    ),
+    -- Lado settlement con las mismas reglas y el mismo grano (fin) que RESUMEN
+    -- SETTLEMENT filtrado por cada partner: los fixed fees de la sesión se
+    -- restan en cada fila de fin y el join a consolidated_info_tab por
+    -- (id_order_item, item_status) puede duplicar filas, igual que en la hoja
+    -- exportada
+    settlement_cancelled_info_tab AS (
+      SELECT id_order_item, IFNULL(-MAX(FT_COLLECTED_BY_FEVER),0) AS hist_collected_by_fever
+      FROM base
+      GROUP BY 1
+    ),
+    settlement_consolidated_info_tab AS (
+      SELECT h.id_order_item, h.item_status,
+             CASE WHEN h.item_status = 'canceled' THEN c.hist_collected_by_fever ELSE h.ft_collected_by_fever END AS collected_by_fever
+      FROM base h
+      LEFT JOIN settlement_cancelled_info_tab c USING (id_order_item)
+    ),
+    settlement_commission_tab AS (
+      SELECT
+        CAST(REPLACE(CAST(h.id_partner AS STRING), ',', '') AS INT64) AS id_partner,
+        h.session_id, h.invoice_id, h.dt_invoice_from, h.dt_invoice_to, h.dt_input, h.settlement_link,
+        SUM(ci.collected_by_fever) AS revenue_collected_by_fever,
+        SUM(CASE WHEN h.item_status = 'validated/expired' THEN h.variable_cc_for_fever_w_taxes ELSE 0 END) AS executed_commission_w_tax,
+        SUM(CASE WHEN h.item_status = 'canceled'           THEN h.variable_cc_for_fever_w_taxes ELSE 0 END) AS cancelled_commission_w_tax,
+        SUM(CASE WHEN h.item_status = 'purchased'          THEN h.variable_cc_for_fever_w_taxes ELSE 0 END) AS ticketing_advance_commission_w_tax
+      FROM base h
+      LEFT JOIN settlement_consolidated_info_tab ci USING (id_order_item, item_status)
+      GROUP BY 1,2,3,4,5,6,7
+    ),
+    settlement_session AS (
+      SELECT
+        c.id_partner,
+        c.session_id,
+        SUM(c.revenue_collected_by_fever - (
+          c.executed_commission_w_tax + c.cancelled_commission_w_tax + c.ticketing_advance_commission_w_tax
+          + COALESCE(f.settlement_fixed_fees_w_tax, 0)
+        )) AS partner_settlement,
+        SUM(c.executed_commission_w_tax + c.cancelled_commission_w_tax) AS settlement_commission_w_tax,
+        -- Fixed fees restados de más por tener el partner varias filas de la sesión en fin
+        (COUNT(*) - 1) * ANY_VALUE(COALESCE(f.settlement_fixed_fees_w_tax, 0)) AS duplicated_fixed_fees_w_tax
+      FROM settlement_commission_tab c
+      LEFT JOIN fees_session f USING (session_id)
+      GROUP BY c.id_partner, c.session_id
     )
-    job.result()
-    
-    logger.info(f"Resultados guardados en {table_name}: {len(results)} filas")
+    SELECT
+      i.id_partner,
+      i.session_id,
+      -- [5] de RESUMEN POR PARTNER
+      i.revenue_collected_by_fever_no_purchased
+        - i.invoice_commission
+        - COALESCE(f.partner_fixed_fees, 0)
+        - (i.invoice_commission_tax + COALESCE(f.partner_fixed_fees_tax, 0)) AS pago_al_partner,
+      -- partner_settlement de RESUMEN SETTLEMENT (suma de las filas del partner en la sesión)
+      COALESCE(st.partner_settlement, 0) AS partner_settlement,
+      i.invoice_commission + i.invoice_commission_tax AS invoice_commission_w_tax,
+      COALESCE(st.settlement_commission_w_tax, 0) AS settlement_commission_w_tax,
+      COALESCE(st.duplicated_fixed_fees_w_tax, 0) AS duplicated_fixed_fees_w_tax
+    FROM items_session i
+    LEFT JOIN fees_session f USING (session_id)
+    LEFT JOIN settlement_session st
+      ON st.session_id = i.session_id AND st.id_partner = i.id_partner
+    ORDER BY i.id_partner, i.session_id
+    """
+    return execute_query_pages(query, summary_params(filters))
+
+
+class BigQueryWriter:
+    """
+    Guarda resultados en una tabla de BigQuery: las páginas se cargan en una
+    tabla de staging (en lotes de hasta BIGQUERY_LOAD_BATCH_BYTES) y close()
+    reemplaza la tabla fechada en un solo copy job con WRITE_TRUNCATE, de modo
+    que un fallo a mitad nunca deja la tabla fechada a medio escribir
+    """
+
+    def __init__(self, table_name: str, schema: Schema, dataset_id: str = DATASET_ID):
+        self.table_name = table_name
+        self.client = get_bigquery_client()
+        self.table_ref = self.client.dataset(dataset_id).table(table_name)
+        self.staging_ref = self.client.dataset(dataset_id).table(
+            f"_staging_{table_name}_{uuid.uuid4().hex[:8]}"
+        )
+        self.schema = [bigquery.SchemaField(name, field_type) for name, field_type in schema]
+        self.staging_created = False
+        self.buffer = io.BytesIO()
+        self.buffered_rows = 0
+        self.load_job = None
+        self.rows = 0
+
+    def _create_staging(self):
+        # La tabla de staging caduca sola por si el proceso muere sin limpiarla
+        table = bigquery.Table(self.staging_ref, schema=self.schema)
+        table.expires = datetime.now(timezone.utc) + timedelta(days=1)
+        with span('bigquery.create_staging'):
+            # exists_ok: un reintento tras un create que sí se completó no falla con 409
+            scheduler.call('bigquery', lambda: self.client.create_table(
+                table, exists_ok=True, retry=BIGQUERY_RETRY
+            ))
+        self.staging_created = True
+
+    def _flush(self):
+        """Carga en la tabla de staging las filas acumuladas en el buffer"""
+        if not self.buffered_rows:
+            return
+        if not self.staging_created:
+            self._create_staging()
+        
+        job_config = bigquery.LoadJobConfig(
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            schema=self.schema
+        )
+        
+        def run_load():
+            # En un reintento se consulta el job anterior antes de reenviar el
+            # lote: si terminó bien (o sigue en curso) reenviarlo con
+            # WRITE_APPEND duplicaría las filas en la tabla de staging
+            if self.load_job is not None:
+                self.load_job.reload(retry=BIGQUERY_RETRY)
+                if self.load_job.state != 'DONE' or not self.load_job.error_result:
+                    return wait_for_job(self.load_job)
+            self.load_job = self.client.load_table_from_file(
+                self.buffer,
+                self.staging_ref,
+                rewind=True,
+                job_config=job_config
+            )
+            return wait_for_job(self.load_job)
+        
+        with span('bigquery.load', rows=self.buffered_rows, bytes=self.buffer.tell()):
+            scheduler.call('bigquery', run_load)
+        self.load_job = None
+        self.buffer = io.BytesIO()
+        self.buffered_rows = 0
+
+    def write_page(self, rows: List[Dict[str, Any]]):
+        """Acumula una página de filas y carga el lote si supera el tamaño máximo"""
+        if not rows:
+            return
+        
+        # Convertir la página a NDJSON (Decimal, date, ...)
+        with span('bigquery.json_convert', rows=len(rows)) as convert_span:
+            encoded = ''.join(json.dumps(row, default=str) + '\n' for row in rows).encode('utf-8')
+            convert_span.set_attribute('bytes', len(encoded))
+        self.buffer.write(encoded)
+        self.buffered_rows += len(rows)
+        self.rows += len(rows)
+        
+        if self.buffer.tell() >= BIGQUERY_LOAD_BATCH_BYTES:
+            self._flush()
+
+    def close(self):
+        """Carga el último lote y reemplaza la tabla fechada con la de staging"""
+        if not self.rows:
+            logger.warning(f"No hay resultados para guardar en {self.table_name}")
+            return
+        
+        self._flush()
+        job_config = bigquery.CopyJobConfig(
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE
+        )
+        
+        def run_copy():
+            job = self.client.copy_table(self.staging_ref, self.table_ref, job_config=job_config)
+            return wait_for_job(job)
+        
+        try:
+            with span('bigquery.copy', rows=self.rows):
+                scheduler.call('bigquery', run_copy)
+        finally:
+            self._drop_staging()
+        logger.info(f"Resultados guardados en {self.table_name}: {self.rows} filas")
+
+    def _drop_staging(self):
+        if not self.staging_created:
+            return
+        try:
+            scheduler.call('bigquery', lambda: self.client.delete_table(
+                self.staging_ref, not_found_ok=True, retry=BIGQUERY_RETRY
+            ))
+            self.staging_created = False
+        except Exception as e:
+            # La tabla de staging caduca sola, no hacemos fallar la petición
+            logger.warning(f"No se pudo eliminar la tabla de staging {self.staging_ref.table_id}: {e}")
 
+    def abort(self):
+        """Descarta la carga: elimina la tabla de staging sin tocar la tabla fechada"""
+        self.buffer = io.BytesIO()
+        self.buffered_rows = 0
+        self._drop_staging()
 
-def export_to_sheets_if_configured(results: list, sheet_id: str = None, sheet_name: str = None):
-    """Exporta resultados a Google Sheets si está configurado"""
-    sheet_id = sheet_id or GOOGLE_SHEETS_ID
+
+def open_bigquery_sink(query_type: str, table_name: str, sheet_name: str, schema: Schema):
+    """Abre el sink de BigQuery (tabla fechada)"""
+    return BigQueryWriter(table_name, schema)
+
+
+def open_sheets_sink_if_configured(query_type: str, table_name: str, sheet_name: str, schema: Schema):
+    """Abre el sink de Google Sheets si está configurado"""
+    sheet_id = GOOGLE_SHEETS_ID
     sheet_name = sheet_name or os.environ.get('GOOGLE_SHEETS_NAME', 'Results')
     
     if not sheet_id:
         logger.info("Google Sheets ID no configurado, omitiendo exportación")
-        return
+        return None
     
     try:
-        from export_to_sheets import export_to_sheets
-        export_to_sheets(sheet_id, sheet_name, results)
-        logger.info(f"Resultados exportados a Google Sheets: {sheet_id}/{sheet_name}")
+        from export_to_sheets import SheetsWriter
     except ImportError:
         logger.warning("Módulo export_to_sheets no disponible")
-    except Exception as e:
-        logger.error(f"Error exportando a Google Sheets: {e}")
+        return None
+    return SheetsWriter(sheet_id, sheet_name, [name for name, _ in schema])
+
+
+def open_parquet_sink_if_configured(query_type: str, table_name: str, sheet_name: str, schema: Schema):
+    """Abre el sink de ficheros Parquet si está configurado"""
+    if not PARQUET_SINK_ROOT:
+        logger.info("PARQUET_SINK_ROOT no configurado, omitiendo exportación")
+        return None
+    
+    try:
+        from export_to_parquet import ParquetWriter
+    except ImportError:
+        logger.warning("Módulo export_to_parquet no disponible")
+        return None
+    return ParquetWriter(PARQUET_SINK_ROOT, query_type, datetime.now().date(), schema)
+
+
+# Sinks de salida disponibles: nombre -> función(query_type, table_name, sheet_name, schema)
+# que retorna un writer con write_page(rows), close() y opcionalmente abort(),
+# o None si no está configurado
+SINKS = {
+    'bigquery': open_bigquery_sink,
+    'sheets': open_sheets_sink_if_configured,
+    'parquet': open_parquet_sink_if_configured,
+}
+
+# Sinks cuyo fallo se registra pero no hace fallar la petición
+OPTIONAL_SINKS = {'sheets'}
+
+# Configuración que necesita cada sink: sin ella se omite si viene por defecto
+# y se rechaza con 400 si la petición lo pide explícitamente
+SINK_SETTINGS = {
+    'sheets': ('GOOGLE_SHEETS_ID', lambda: GOOGLE_SHEETS_ID),
+    'parquet': ('PARQUET_SINK_ROOT', lambda: PARQUET_SINK_ROOT),
+}
+
+
+def write_pages(pages: Iterator[List[Dict[str, Any]]], writers: Dict[str, Any]) -> int:
+    """
+    Entrega cada página a todos los writers antes de pedir la siguiente, de
+    modo que la memoria queda acotada por el tamaño de página. Retorna el
+    número de filas procesadas. Si la petición falla, se llama a abort() en
+    los writers que aún no se cerraron para descartar lo escrito a medias.
+    """
+    pending = dict(writers)
+    
+    def abort(name):
+        writer = pending.pop(name, None)
+        if writer is None or not hasattr(writer, 'abort'):
+            return
+        try:
+            writer.abort()
+        except Exception as e:
+            logger.warning(f"No se pudo descartar la exportación a {name}: {e}")
+    
+    def run(name, action):
+        try:
+            action()
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            if name not in OPTIONAL_SINKS:
+                raise
+            logger.error(f"Error exportando a {name}: {e}")
+            del writers[name]
+            abort(name)
+    
+    rows = 0
+    try:
+        for page in pages:
+            rows += len(page)
+            for name, writer in list(writers.items()):
+                with span(f'sink.{name}.write_page', rows=len(page)):
+                    run(name, lambda: writer.write_page(page))
+        for name, writer in list(writers.items()):
+            with span(f'sink.{name}.close'):
+                run(name, writer.close)
+            pending.pop(name, None)
+    except BaseException:
+        for name in list(pending):
+            abort(name)
+        raise
+    return rows
+
+
+def parse_sinks(value: Any) -> List[str]:
+    """Obtiene la lista de sinks de la petición (lista o separados por comas)"""
+    value = value or DEFAULT_SINKS
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, (list, tuple)):
+        raise TypeError("sinks debe ser una lista o nombres separados por comas")
+    sinks = [str(name).strip().lower() for name in value if str(name).strip()]
+    unknown = [name for name in sinks if name not in SINKS]
+    if unknown:
+        raise ValueError(f"Sinks no soportados: {', '.join(unknown)}")
+    return sinks
+
+
+def unconfigured_sinks(sinks: List[str]) -> List[str]:
+    """Sinks de la lista a los que les falta configuración (ver SINK_SETTINGS)"""
+    return [
+        f"{name} ({SINK_SETTINGS[name][0]})" for name in sinks
+        if name in SINK_SETTINGS and not SINK_SETTINGS[name][1]()
+    ]
+
+
+def parse_filters(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Obtiene los filtros de la petición: id_partner (tiene prioridad sobre
+    cd_contract) y rango opcional date_from/date_to sobre dt_input
+    """
+    filters = {'id_partner': None, 'cd_contract': None, 'date_from': None, 'date_to': None}
+    if data.get('id_partner'):
+        filters['id_partner'] = int(str(data['id_partner']).replace(',', ''))
+    elif data.get('cd_contract'):
+        filters['cd_contract'] = str(data['cd_contract'])
+    if data.get('date_from'):
+        filters['date_from'] = date.fromisoformat(data['date_from'])
+    if data.get('date_to'):
+        filters['date_to'] = date.fromisoformat(data['date_to'])
+    return filters
 
 
 def jfc_cash_to_pay_audit(request: Request) -> Dict[str, Any]:
@@ -624,61 +1407,109 @@ def jfc_cash_to_pay_audit(request: Request) -> Dict[str, Any]:
     }
     
     try:
-        # Obtener parámetros
-        if request.method == 'GET':
-            data = request.args.to_dict()
-        else:
-            data = request.get_json(silent=True) or {}
+        with request_deadline(), span('jfc_cash_to_pay_audit') as request_span:
+            # Obtener parámetros
+            if request.method == 'GET':
+                data = request.args.to_dict()
+            else:
+                data = request.get_json(silent=True) or {}
         
-        query_type = data.get('query_type', 'partner_summary')
-        id_partner = data.get('id_partner')
-        cd_contract = data.get('cd_contract')
+            query_type = data.get('query_type', 'partner_summary')
         
-        logger.info(f"Ejecutando query tipo: {query_type}")
+            logger.info(f"Ejecutando query tipo: {query_type}")
+            request_span.set_attribute('query_type', query_type)
         
-        # Construir WHERE clause si hay filtros
-        where_clause = ''
-        if id_partner:
-            where_clause = f" WHERE CAST(REPLACE(id_partner, ',', '') AS INT64) = {id_partner}"
-        elif cd_contract:
-            where_clause = f" WHERE cd_contract = '{cd_contract}'"
+            try:
+                sinks = parse_sinks(data.get('sinks'))
+            except (TypeError, ValueError) as e:
+                return (json.dumps({"error": str(e)}), 400, headers)
+            # Los sinks pedidos explícitamente tienen que estar configurados
+            explicit_sinks = bool(data.get('sinks'))
+            if explicit_sinks and unconfigured_sinks(sinks):
+                return (json.dumps({
+                    "error": f"Sinks no configurados: {', '.join(unconfigured_sinks(sinks))}"
+                }), 400, headers)
         
-        # Ejecutar query según tipo
-        if query_type == 'partner_summary':
-            results = get_partner_summary(where_clause)
-            table_name = f'partner_summary_{datetime.now().strftime("%Y%m%d")}'
-            sheet_name = 'Partner Summary'
-        elif query_type == 'invoice_summary':
-            results = get_invoice_summary(where_clause)
-            table_name = f'invoice_summary_{datetime.now().strftime("%Y%m%d")}'
-            sheet_name = 'Invoice Summary'
-        elif query_type == 'settlement_summary':
-            results = get_settlement_summary(where_clause)
-            table_name = f'settlement_summary_{datetime.now().strftime("%Y%m%d")}'
-            sheet_name = 'Settlement Summary'
-        else:
-            return (json.dumps({"error": "Tipo de query no válido"}), 400, headers)
+            # Filtros como parámetros de query (nunca interpolados en el SQL)
+            try:
+                filters = parse_filters(data)
+            except (TypeError, ValueError) as e:
+                return (json.dumps({"error": f"Filtros no válidos: {e}"}), 400, headers)
         
-        # Guardar resultados en BigQuery
-        save_results_to_bigquery(results, table_name)
+            # Ejecutar query según tipo
+            if query_type == 'partner_summary':
+                schema, pages = get_partner_summary(filters)
+                table_name = f'partner_summary_{datetime.now().strftime("%Y%m%d")}'
+                sheet_name = 'Partner Summary'
+            elif query_type == 'partner_summary_as_of':
+                try:
+                    period_ends = parse_period_ends(data)
+                except (TypeError, ValueError) as e:
+                    return (json.dumps({"error": f"Fechas de corte no válidas: {e}"}), 400, headers)
+                schema, pages = get_partner_summary_as_of(period_ends, filters)
+                table_name = f'partner_summary_as_of_{datetime.now().strftime("%Y%m%d")}'
+                sheet_name = 'Partner Summary As Of'
+            elif query_type == 'reconciliation':
+                from reconciliation import TOLERANCE_ABS, TOLERANCE_REL, iter_discrepancy_report, report_schema
+                try:
+                    tolerance_abs = float(data.get('tolerance_abs', TOLERANCE_ABS))
+                    tolerance_rel = float(data.get('tolerance_rel', TOLERANCE_REL))
+                except (TypeError, ValueError):
+                    return (json.dumps({"error": "Tolerancias no válidas"}), 400, headers)
+                schema, pages = get_reconciliation_data(filters)
+                schema = report_schema(schema)
+                pages = iter_discrepancy_report(pages, tolerance_abs, tolerance_rel)
+                table_name = f'reconciliation_{datetime.now().strftime("%Y%m%d")}'
+                sheet_name = 'Reconciliation'
+            elif query_type == 'invoice_summary':
+                schema, pages = get_invoice_summary(filters)
+                table_name = f'invoice_summary_{datetime.now().strftime("%Y%m%d")}'
+                sheet_name = 'Invoice Summary'
+            elif query_type == 'settlement_summary':
+                schema, pages = get_settlement_summary(filters)
+                table_name = f'settlement_summary_{datetime.now().strftime("%Y%m%d")}'
+                sheet_name = 'Settlement Summary'
+            else:
+                return (json.dumps({"error": "Tipo de query no válido"}), 400, headers)
         
-        # Exportar a Google Sheets (siempre, usando el spreadsheet configurado)
-        export_to_sheets_if_configured(results, sheet_name=sheet_name)
+            # Guardar resultados en los sinks pedidos (por defecto BigQuery y Google Sheets),
+            # página a página
+            writers = {}
+            for sink in sinks:
+                writer = SINKS[sink](query_type, table_name, sheet_name, schema)
+                if writer is not None:
+                    writers[sink] = writer
+                elif explicit_sinks:
+                    return (json.dumps({"error": f"Sink no disponible: {sink}"}), 400, headers)
+            rows_returned = write_pages(pages, writers)
+            request_span.set_attribute('rows', rows_returned)
         
-        result = {
-            "status": "success",
-            "query_type": query_type,
-            "rows_returned": len(results),
-            "table_name": table_name,
-            "dataset": DATASET_ID,
-            "project": PROJECT_ID,
-            "timestamp": datetime.now().isoformat()
-        }
+            result = {
+                "status": "success",
+                "query_type": query_type,
+                "rows_returned": rows_returned,
+                "table_name": table_name,
+                # Solo los sinks que se escribieron (write_pages descarta los opcionales que fallan)
+                "sinks": list(writers),
+                "dataset": DATASET_ID,
+                "project": PROJECT_ID,
+                "timestamp": datetime.now().isoformat(),
+                "throttling": scheduler.metrics_snapshot(),
+                "trace_id": request_span.trace_id
+            }
         
-        logger.info(f"Query ejecutada exitosamente: {len(results)} filas")
+            logger.info(f"Query ejecutada exitosamente: {rows_returned} filas")
         
-        return (json.dumps(result), 200, headers)
+            return (json.dumps(result), 200, headers)
         
+    except DeadlineExceeded as e:
+        logger.error(f"Deadline de la petición agotado: {e}")
+        error_response = {
+            "status": "error",
+            "message": str(e),
+            "throttling": scheduler.metrics_snapshot()
+        }
+        return (json.dumps(error_response), 504, headers)
     except Exception as e:
         logger.error(f"Error ejecutando query: {str(e)}", exc_info=True)
         error_response = {
@@ -0,0 +1,228 @@
+"""
+Planificador de llamadas a las APIs de Google (Sheets y BigQuery)
+con límites de cuota, reintentos con backoff y deadline global por request
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+from tracing import current_span
+
+logger = logging.getLogger(__name__)
+
+# Límites por API: (peticiones por segundo, ráfaga máxima)
+RATE_LIMITS = {
+    'sheets': (
+        float(os.environ.get('SHEETS_RATE_PER_SECOND', '1')),
+        int(os.environ.get('SHEETS_BURST', '5')),
+    ),
+    'bigquery': (
+        float(os.environ.get('BIGQUERY_RATE_PER_SECOND', '5')),
+        int(os.environ.get('BIGQUERY_BURST', '10')),
+    ),
+}
+
+MAX_RETRIES = int(os.environ.get('API_MAX_RETRIES', '5'))
+BACKOFF_BASE_SECONDS = float(os.environ.get('API_BACKOFF_BASE_SECONDS', '1'))
+BACKOFF_MAX_SECONDS = float(os.environ.get('API_BACKOFF_MAX_SECONDS', '32'))
+
+# Cloud Run corta la petición a los 60s; dejamos margen para responder
+REQUEST_DEADLINE_SECONDS = float(os.environ.get('REQUEST_DEADLINE_SECONDS', '55'))
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+RETRYABLE_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'backendError', 'internalError'}
+
+_deadline: ContextVar[Optional[float]] = ContextVar('request_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Se agotó el tiempo máximo de la petición esperando a la API"""
+
+
+class TokenBucket:
+    """Token bucket thread-safe para limitar peticiones por segundo"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> float:
+        """Espera hasta obtener un token y retorna los segundos esperados"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            check_deadline(wait)
+            time.sleep(wait)
+            waited += wait
+
+
+@contextmanager
+def request_deadline(seconds: float = REQUEST_DEADLINE_SECONDS):
+    """Fija el deadline global de la petición HTTP en curso"""
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_seconds() -> Optional[float]:
+    """Segundos restantes hasta el deadline de la petición (None si no hay)"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def check_deadline(wait: float = 0.0):
+    """Lanza DeadlineExceeded si esperar `wait` segundos supera el deadline"""
+    remaining = remaining_seconds()
+    if remaining is not None and wait >= remaining:
+        raise DeadlineExceeded(
+            f"Deadline de la petición agotado (restan {remaining:.1f}s, se necesitan {wait:.1f}s)"
+        )
+
+
+def _error_details(error: Exception):
+    """
+    Extrae (status, reasons, retry_after) de errores de googleapiclient
+    (HttpError) y de google.api_core (errores de BigQuery)
+    """
+    status = None
+    reasons = set()
+    retry_after = None
+    headers = {}
+
+    # googleapiclient.errors.HttpError
+    resp = getattr(error, 'resp', None)
+    if resp is not None:
+        status = getattr(resp, 'status', None)
+        headers = resp
+        for detail in getattr(error, 'error_details', None) or []:
+            if isinstance(detail, dict) and detail.get('reason'):
+                reasons.add(detail['reason'])
+
+    # google.api_core.exceptions.GoogleAPICallError
+    code = getattr(error, 'code', None)
+    if status is None and isinstance(code, int):
+        status = code
+    for detail in getattr(error, 'errors', None) or []:
+        if isinstance(detail, dict) and detail.get('reason'):
+            reasons.add(detail['reason'])
+    response = getattr(error, 'response', None)
+    if response is not None and getattr(response, 'headers', None):
+        headers = response.headers
+
+    try:
+        value = headers.get('retry-after') or headers.get('Retry-After')
+        if value is not None:
+            retry_after = float(value)
+    except (AttributeError, TypeError, ValueError):
+        retry_after = None
+
+    return status, reasons, retry_after
+
+
+def is_retryable(error: Exception) -> bool:
+    """Indica si el error es un throttling o fallo transitorio"""
+    status, reasons, _ = _error_details(error)
+    if reasons & RETRYABLE_REASONS:
+        return True
+    return status in RETRYABLE_STATUS
+
+
+class QuotaScheduler:
+    """
+    Planificador compartido de llamadas a APIs: aplica token bucket por API,
+    reintenta con backoff exponencial con jitter (respetando Retry-After),
+    respeta el deadline de la petición y contabiliza el throttling
+    """
+
+    def __init__(self, limits: Dict[str, tuple] = None, max_retries: int = MAX_RETRIES,
+                 backoff_base: float = BACKOFF_BASE_SECONDS, backoff_max: float = BACKOFF_MAX_SECONDS):
+        limits = limits or RATE_LIMITS
+        self.buckets = {api: TokenBucket(rate, burst) for api, (rate, burst) in limits.items()}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+        self.metrics = {
+            api: {'calls': 0, 'retries': 0, 'throttled': 0, 'failures': 0, 'wait_seconds': 0.0}
+            for api in self.buckets
+        }
+
+    def _record(self, api: str, key: str, value: float = 1):
+        with self.lock:
+            self.metrics[api][key] += value
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        # Full jitter: uniforme entre 0 y base * 2^attempt (acotado)
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, api: str, fn: Callable[[], Any]) -> Any:
+        """Ejecuta fn() contra la API indicada con límites y reintentos"""
+        bucket = self.buckets[api]
+        attempt = 0
+        while True:
+            check_deadline()
+            waited = bucket.acquire()
+            if waited:
+                self._record(api, 'wait_seconds', waited)
+                if current_span():
+                    current_span().add('rate_limit_wait_s', waited)
+            self._record(api, 'calls')
+            try:
+                return fn()
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    self._record(api, 'failures')
+                    raise
+                status, reasons, retry_after = _error_details(e)
+                throttled = status == 429 or bool(reasons & {'rateLimitExceeded', 'userRateLimitExceeded'})
+                if throttled:
+                    self._record(api, 'throttled')
+                delay = self._backoff(attempt, retry_after)
+                check_deadline(delay)
+                attempt += 1
+                self._record(api, 'retries')
+                self._record(api, 'wait_seconds', delay)
+                if current_span():
+                    current_span().add('retries')
+                    if throttled:
+                        current_span().add('throttled')
+                logger.warning(
+                    f"Llamada a {api} limitada o con error transitorio ({status}); "
+                    f"reintento {attempt}/{self.max_retries} en {delay:.1f}s"
+                )
+                time.sleep(delay)
+
+    def metrics_snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Copia de las métricas de throttling acumuladas en el proceso"""
+        with self.lock:
+            return {api: dict(values) for api, values in self.metrics.items()}
+
+
+# Planificador compartido por todo el proceso
+scheduler = QuotaScheduler()
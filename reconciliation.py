@@ -0,0 +1,141 @@
+"""
+Módulo de conciliación de pagos a partner: compara pago_al_partner
+(RESUMEN POR PARTNER) con partner_settlement (RESUMEN SETTLEMENT) y la
+comisión de invoice con la de settlement, por partner y por sesión
+"""
+
+import logging
+import os
+from typing import List, Dict, Any, Iterable, Iterator, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Tolerancias por defecto: |diferencia| <= max(abs, rel * |importe mayor|)
+TOLERANCE_ABS = float(os.environ.get('RECONCILIATION_TOLERANCE_ABS', '0.01'))
+TOLERANCE_REL = float(os.environ.get('RECONCILIATION_TOLERANCE_REL', '0'))
+
+AMOUNT_COLUMNS = [
+    'pago_al_partner',
+    'partner_settlement',
+    'invoice_commission_w_tax',
+    'settlement_commission_w_tax',
+    # Informativo: fixed fees que RESUMEN SETTLEMENT resta más de una vez
+    # (una por cada fila invoice/dt_input del partner en la sesión)
+    'duplicated_fixed_fees_w_tax',
+]
+
+REPORT_COLUMNS = [
+    'level', 'id_partner', 'session_id',
+    'pago_al_partner', 'partner_settlement', 'diff_payment',
+    'invoice_commission_w_tax', 'settlement_commission_w_tax', 'diff_commission',
+    'duplicated_fixed_fees_w_tax', 'status',
+]
+
+
+def _within_tolerance(left: pd.Series, right: pd.Series, diff: pd.Series,
+                      tolerance_abs: float, tolerance_rel: float) -> np.ndarray:
+    allowed = np.maximum(tolerance_abs, tolerance_rel * np.maximum(left.abs(), right.abs()))
+    return (diff.abs() <= allowed).to_numpy()
+
+
+def build_discrepancy_report(
+    rows: List[Dict[str, Any]],
+    tolerance_abs: float = TOLERANCE_ABS,
+    tolerance_rel: float = TOLERANCE_REL
+) -> List[Dict[str, Any]]:
+    """
+    Construye el informe de discrepancias a partir de las filas por sesión
+    de get_reconciliation_data. Todas las comparaciones son operaciones
+    vectorizadas por columna sobre el conjunto completo de partners.
+
+    Args:
+        rows: Filas por partner_id/session_id con los importes de cada resumen
+        tolerance_abs: Diferencia absoluta admitida
+        tolerance_rel: Diferencia relativa admitida (sobre el importe mayor)
+
+    Returns:
+        Lista de diccionarios: una fila 'partner' con los totales de cada
+        partner seguida de sus filas 'session'
+    """
+    if not rows:
+        return []
+
+    sessions = pd.DataFrame(rows, columns=['id_partner', 'session_id'] + AMOUNT_COLUMNS)
+    sessions[AMOUNT_COLUMNS] = sessions[AMOUNT_COLUMNS].astype(float).fillna(0.0)
+    # Entero con nulos: con un id_partner NULL pandas pasaría la columna a float64
+    sessions['id_partner'] = sessions['id_partner'].astype('Int64')
+    sessions['level'] = 'session'
+
+    partners = sessions.groupby('id_partner', as_index=False, dropna=False)[AMOUNT_COLUMNS].sum()
+    partners['session_id'] = None
+    partners['level'] = 'partner'
+
+    report = pd.concat([partners, sessions], ignore_index=True)
+    report['diff_payment'] = report['pago_al_partner'] - report['partner_settlement']
+    report['diff_commission'] = report['invoice_commission_w_tax'] - report['settlement_commission_w_tax']
+
+    payment_ok = _within_tolerance(
+        report['pago_al_partner'], report['partner_settlement'], report['diff_payment'],
+        tolerance_abs, tolerance_rel
+    )
+    commission_ok = _within_tolerance(
+        report['invoice_commission_w_tax'], report['settlement_commission_w_tax'], report['diff_commission'],
+        tolerance_abs, tolerance_rel
+    )
+    report['status'] = np.where(payment_ok & commission_ok, 'OK', 'DISCREPANCIA')
+
+    # Fila de partner primero y después sus sesiones
+    report['level_order'] = (report['level'] == 'session').astype(int)
+    report = report.sort_values(
+        ['id_partner', 'level_order', 'session_id'], na_position='first', kind='stable'
+    )[REPORT_COLUMNS]
+
+    discrepancies = int((report['status'] != 'OK').sum())
+    logger.debug(
+        f"Conciliación: {len(partners)} partners, {len(sessions)} sesiones, "
+        f"{discrepancies} filas con discrepancias"
+    )
+
+    # Tipos nativos de Python y None en lugar de NaN para los sinks
+    report = report.astype(object)
+    return report.where(pd.notna(report), None).to_dict('records')
+
+
+def report_schema(schema: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """Schema [(nombre, tipo BigQuery)] del informe a partir del de la query"""
+    types = dict(schema)
+    return [
+        (name, types.get(name, 'STRING') if name in ('id_partner', 'session_id')
+         else 'STRING' if name in ('level', 'status') else 'FLOAT')
+        for name in REPORT_COLUMNS
+    ]
+
+
+def iter_discrepancy_report(
+    pages: Iterable[List[Dict[str, Any]]],
+    tolerance_abs: float = TOLERANCE_ABS,
+    tolerance_rel: float = TOLERANCE_REL
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Versión paginada de build_discrepancy_report. Las páginas deben venir
+    ordenadas por id_partner: las sesiones del último partner de cada página
+    se retienen hasta la siguiente, así cada partner se concilia completo y
+    en memoria solo hay una página más las sesiones de un partner.
+    """
+    pending = []
+    for page in pages:
+        rows = pending + page
+        if not rows:
+            continue
+        last_partner = rows[-1]['id_partner']
+        split = len(rows)
+        while split > 0 and rows[split - 1]['id_partner'] == last_partner:
+            split -= 1
+        complete, pending = rows[:split], rows[split:]
+        if complete:
+            yield build_discrepancy_report(complete, tolerance_abs, tolerance_rel)
+    if pending:
+        yield build_discrepancy_report(pending, tolerance_abs, tolerance_rel)
@@ -0,0 +1,208 @@
+"""
+Trazas ligeras por etapa (spans anidados) para el camino crítico de
+jfc_cash_to_pay_audit, con exportación a fichero JSON lines y/o a un
+colector compatible con OTLP/HTTP (JSON)
+
+Uso del CLI para resumir latencias por etapa:
+    python tracing.py summary traces.jsonl [traces2.jsonl ...]
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = 'jfc-cash-to-pay-audit'
+
+# Destinos de exportación (vacío = desactivado)
+TRACE_FILE = os.environ.get('TRACE_FILE', '')
+OTLP_ENDPOINT = os.environ.get('OTLP_ENDPOINT', '')  # p.ej. http://localhost:4318/v1/traces
+
+_current_span: ContextVar[Optional['Span']] = ContextVar('current_span', default=None)
+_file_lock = threading.Lock()
+
+
+class Span:
+    """Etapa medida con atributos; los spans hijos comparten trace_id"""
+
+    def __init__(self, name: str, parent: Optional['Span'] = None, attributes: Dict[str, Any] = None):
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.attributes = dict(attributes or {})
+        self.status = 'ok'
+        self.error = None
+        self.start = time.time()
+        self.start_perf = time.perf_counter()
+        self.duration_ms = None
+        # Spans terminados de la traza, se exportan al cerrar el span raíz
+        self.finished = parent.finished if parent else []
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def add(self, key: str, value: float = 1):
+        """Incrementa un contador del span (p.ej. reintentos)"""
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent.span_id if self.parent else None,
+            'name': self.name,
+            'start': self.start,
+            'duration_ms': self.duration_ms,
+            'status': self.status,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+
+def current_span() -> Optional[Span]:
+    """Span activo en el contexto actual (None fuera de una traza)"""
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Mide una etapa como span hijo del span activo"""
+    current = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = 'error'
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        current.duration_ms = (time.perf_counter() - current.start_perf) * 1000
+        current.finished.append(current)
+        if current.parent is None:
+            export(current.finished)
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_payload(spans: List[Span]) -> Dict[str, Any]:
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}}]},
+            'scopeSpans': [{
+                'scope': {'name': __name__},
+                'spans': [{
+                    'traceId': s.trace_id,
+                    'spanId': s.span_id,
+                    'parentSpanId': s.parent.span_id if s.parent else '',
+                    'name': s.name,
+                    'kind': 1,
+                    'startTimeUnixNano': str(int(s.start * 1e9)),
+                    'endTimeUnixNano': str(int((s.start + s.duration_ms / 1000) * 1e9)),
+                    'attributes': [{'key': k, 'value': _otlp_value(v)} for k, v in s.attributes.items()],
+                    # 1 = OK, 2 = ERROR
+                    'status': {'code': 2, 'message': s.error} if s.status == 'error' else {'code': 1},
+                } for s in spans],
+            }],
+        }],
+    }
+
+
+def export(spans: List[Span]):
+    """Exporta los spans de una traza a los destinos configurados"""
+    if TRACE_FILE:
+        try:
+            lines = ''.join(json.dumps(s.to_dict(), default=str) + '\n' for s in spans)
+            with _file_lock, open(TRACE_FILE, 'a', encoding='utf-8') as f:
+                f.write(lines)
+        except OSError as e:
+            logger.warning(f"No se pudieron escribir las trazas en {TRACE_FILE}: {e}")
+
+    if OTLP_ENDPOINT:
+        request = urllib.request.Request(
+            OTLP_ENDPOINT,
+            data=json.dumps(_otlp_payload(spans), default=str).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        )
+        try:
+            urllib.request.urlopen(request, timeout=2).close()
+        except Exception as e:
+            logger.warning(f"No se pudieron enviar las trazas a {OTLP_ENDPOINT}: {e}")
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    """Percentil por rango más cercano"""
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(paths: List[str]) -> List[Dict[str, Any]]:
+    """Latencias por etapa (nombre de span) a partir de ficheros JSON lines"""
+    durations: Dict[str, List[float]] = {}
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                durations.setdefault(record['name'], []).append(record['duration_ms'])
+
+    summary = []
+    for name, values in durations.items():
+        values.sort()
+        summary.append({
+            'stage': name,
+            'count': len(values),
+            'p50_ms': _percentile(values, 50),
+            'p90_ms': _percentile(values, 90),
+            'p99_ms': _percentile(values, 99),
+            'max_ms': values[-1],
+            'total_ms': sum(values),
+        })
+    return sorted(summary, key=lambda row: row['total_ms'], reverse=True)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Resumen de latencias por etapa de las trazas')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    summary_parser = subparsers.add_parser('summary', help='Percentiles de latencia por etapa')
+    summary_parser.add_argument('paths', nargs='+', help='Ficheros JSON lines generados con TRACE_FILE')
+    summary_parser.add_argument('--json', action='store_true', help='Salida en JSON')
+    args = parser.parse_args(argv)
+
+    summary = summarize(args.paths)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return 0
+
+    columns = ['count', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'total_ms']
+    width = max([len('stage')] + [len(row['stage']) for row in summary])
+    print(f"{'stage':<{width}}  " + '  '.join(f"{c:>10}" for c in columns))
+    for row in summary:
+        values = [f"{row['count']:>10}"] + [f"{row[c]:>10.1f}" for c in columns[1:]]
+        print(f"{row['stage']:<{width}}  " + '  '.join(values))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())